@@ -0,0 +1,57 @@
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Times "hashcheck.py -g" on a fixed set of new files against databases of growing size.
+# With constant-time DB lookups the time per run should grow linearly with the DB size
+# (loading it), not with DB size x number of files.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate time vs DB size")
+    parser.add_argument("--rows", help="DB sizes to test", nargs="+", type=int, default=[10000, 20000, 40000, 80000, 160000])
+    parser.add_argument("--files", help="Number of new files to hash", type=int, default=2000)
+    parser.add_argument("--script", help="Script to benchmark", default=os.path.join(ROOT, "hashcheck.py"))
+    return parser.parse_args()
+
+def make_tree(path, count):
+    os.makedirs(path)
+    for i in range(count):
+        with open(os.path.join(path, "file{:06d}".format(i)), "wb") as f:
+            f.write(os.urandom(64))
+
+def make_db(dbfile, rows):
+    db = sqlite3.connect(dbfile)
+    db.execute("CREATE TABLE IF NOT EXISTS hashes(id INTEGER PRIMARY KEY, filename TEXT NOT NULL, sha256 TEXT NOT NULL, filesize INTEGER, creation_date TEXT, modified_date TEXT, timestamp TEXT, session INTEGER)")
+    now = datetime.now()
+    db.executemany("INSERT INTO hashes VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)",
+        (("/nonexistent/dir{}/file{:08d}".format(i // 1000, i), "0" * 64, 64, now, now, now, 1) for i in range(rows)))
+    db.commit()
+    db.close()
+
+def run(script, dbfile, path, mode="-g"):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, mode, "-d", dbfile, path], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+if __name__ == "__main__" :
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, "tree")
+        make_tree(tree, args.files)
+        empty = os.path.join(tmp, "empty")
+        os.makedirs(empty)
+        print("{:>10} {:>10} {:>14}".format("rows", "time (s)", "us/row"))
+        for rows in args.rows:
+            dbfile = os.path.join(tmp, "bench{}.sqlite".format(rows))
+            make_db(dbfile, rows)
+            # The DB is built with the v1 schema, let a first run upgrade it outside the timing
+            run(args.script, dbfile, empty, "-e")
+            elapsed = run(args.script, dbfile, tree)
+            print("{:>10} {:>10.2f} {:>14.2f}".format(rows, elapsed, elapsed / rows * 1e6))
@@ -0,0 +1,38 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Times many short "hashcheck.py -e" runs on a single file, which is mostly interpreter startup,
+# imports and opening the DB. Optional features shouldn't add to it when they aren't used.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Startup time of short runs")
+    parser.add_argument("--runs", help="Number of runs", type=int, default=50)
+    parser.add_argument("--script", help="Scripts to benchmark", nargs="+", default=[os.path.join(ROOT, "hashcheck.py")])
+    return parser.parse_args()
+
+def run(script, dbfile, path):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script, "-e", "-d", dbfile, path], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+if __name__ == "__main__" :
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "file")
+        with open(path, "wb") as f:
+            f.write(os.urandom(64))
+        print("{:>10} {:>10} {:>10}  {}".format("runs", "mean (ms)", "min (ms)", "script"))
+        for script in args.script:
+            dbfile = os.path.join(tmp, "startup.sqlite")
+            if os.path.exists(dbfile):
+                os.remove(dbfile)
+            # The first run creates the DB
+            run(script, dbfile, path)
+            times = [run(script, dbfile, path) for i in range(args.runs)]
+            print("{:>10} {:>10.1f} {:>10.1f}  {}".format(args.runs, sum(times) / len(times) * 1000, min(times) * 1000, script))
@@ -0,0 +1,212 @@
+import argparse
+import importlib.util
+import json
+import os
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+# Times the main stages of hashcheck separately on synthetic trees and DBs of growing size and
+# prints the results as JSON. Each stage runs in its own process so peak RSS is per stage.
+#
+# Layout under the work folder:
+#   data/tree   many tiny files, a few huge files and a deep folder chain, all on disk
+#   data/ghost  never created, the DB rows of each size point there so they are all "missing"
+# Generate and check work on data/tree, getSubset and prune on data (tree + ghost rows).
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="hashcheck benchmark suite")
+    parser.add_argument("--rows", help="DB sizes to test", nargs="+", type=int, default=[10000, 100000, 1000000])
+    parser.add_argument("--tiny-files", help="Number of 1KB files", type=int, default=5000)
+    parser.add_argument("--huge-files", help="Number of huge files", type=int, default=2)
+    parser.add_argument("--huge-mb", help="Size of each huge file in MB", type=int, default=256)
+    parser.add_argument("--depth", help="Depth of the deep folder chain", type=int, default=32)
+    parser.add_argument("--dir", help="Work folder (default: a temporary folder)")
+    parser.add_argument("--script", help="Script to benchmark", default=os.path.join(ROOT, "hashcheck.py"))
+    parser.add_argument("--hashcheck-args", help="Extra hashcheck options, e.g. --hashcheck-args=\"-j 4 -a blake2b\"", default="")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--child", help=argparse.SUPPRESS, nargs=3)
+    return parser.parse_args()
+
+def load_script(path):
+    spec = importlib.util.spec_from_file_location("hashcheck", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_tree(tree, tiny, huge, huge_mb, depth):
+    for i in range(tiny):
+        folder = os.path.join(tree, "tiny", "d{:04d}".format(i // 100))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "file{:06d}".format(i)), "wb") as f:
+            f.write(os.urandom(1024))
+    os.makedirs(os.path.join(tree, "huge"))
+    block = os.urandom(1048576)
+    for i in range(huge):
+        with open(os.path.join(tree, "huge", "file{}".format(i)), "wb") as f:
+            for j in range(huge_mb):
+                f.write(block)
+    folder = os.path.join(tree, "deep")
+    for i in range(depth):
+        folder = os.path.join(folder, "level{:02d}".format(i))
+        os.makedirs(folder)
+        with open(os.path.join(folder, "file"), "wb") as f:
+            f.write(os.urandom(1024))
+
+def make_db(hc, dbfile, rows, ghost):
+    db = sqlite3.connect(dbfile)
+    hc.create_schema(db)
+    db.executemany("INSERT INTO directories (id, path) VALUES (?, ?)",
+        ((i + 1, os.path.join(ghost, "dir{:05d}".format(i)) + os.sep) for i in range((rows + 999) // 1000)))
+    now = time.time_ns()
+    db.executemany("INSERT INTO hashes (directory, name, digest, algorithm, filesize, creation_ns, modified_ns, timestamp_ns, session) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((i // 1000 + 1, "file{:08d}".format(i), bytes(32), "sha256", 1024, now, now, now, 1) for i in range(rows)))
+    db.commit()
+    db.close()
+
+def db_rows(dbfile):
+    db = sqlite3.connect(dbfile)
+    rows = db.execute("SELECT count(*) FROM hashes").fetchone()[0]
+    db.close()
+    return rows
+
+def tree_size(tree):
+    files = 0
+    size = 0
+    for (folder, dirs, names) in os.walk(tree):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(folder, name))
+    return (files, size)
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return rss / 1048576 if sys.platform == "darwin" else rss / 1024
+
+def record(phase, rows, files, size, seconds):
+    return {
+        "phase": phase,
+        "rows": rows,
+        "files": files,
+        "bytes": size,
+        "seconds": round(seconds, 4),
+        "files_per_s": round(files / seconds, 1) if seconds > 0 else None,
+        "mb_per_s": round(size / 1048576 / seconds, 1) if seconds > 0 and size else None,
+        "peak_rss_mb": None,
+    }
+
+def setup(hc, mode, dbfile, path, extra):
+    # A HashCheck on dbfile with the options hashcheck would get on the command line
+    sys.argv = ["hashcheck.py", mode, "-d", dbfile] + extra + [path]
+    args = hc.parse_args()
+    args.session = 1
+    return hc.HashCheck(dbfile, args)
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return (result, time.perf_counter() - start)
+
+def run_child(hc, phase, dbfile, data, extra):
+    # Returns the records of one stage, run in a fresh process
+    tree = os.path.join(data, "tree")
+    rows = db_rows(dbfile)
+    (files, size) = tree_size(tree)
+    results = []
+    # The stages are timed separately, so generate and prune are run without the save that ends their call
+    if phase == "getFileList":
+        engine = setup(hc, "-e", dbfile, tree, extra)
+        (filelist, seconds) = timed(lambda: list(engine.getFileList(tree, True)))
+        results.append(record("getFileList", None, len(filelist), 0, seconds))
+    elif phase == "getSubset":
+        engine = setup(hc, "-e", dbfile, data, extra)
+        (new, seconds) = timed(lambda: list(engine.getSubset(data, True, True)))
+        results.append(record("getSubset new", rows, rows + len(new), 0, seconds))
+        (missing, seconds) = timed(lambda: list(engine.getSubset(data, False, True)))
+        results.append(record("getSubset missing", rows, rows + files, 0, seconds))
+    elif phase == "generate_hashes":
+        engine = setup(hc, "-g", dbfile, tree, extra)
+        def generate():
+            list(engine.generate_hashes(engine.getSubset(tree, True, True), False))
+            engine.writer.flush()
+        (result, seconds) = timed(generate)
+        results.append(record("generate_hashes", rows, files, size, seconds))
+        (result, seconds) = timed(engine.save_db)
+        results.append(record("save_db", rows, rows + files, os.path.getsize(dbfile), seconds))
+    elif phase == "check_hashes":
+        engine = setup(hc, "-c", dbfile, tree, extra)
+        (result, seconds) = timed(lambda: list(engine.check(tree)))
+        results.append(record("check_hashes", rows, files, size, seconds))
+    elif phase == "prune_db":
+        engine = setup(hc, "-p", dbfile, data, extra)
+        (result, seconds) = timed(lambda: list(engine.prune_db(data)))
+        results.append(record("prune_db", rows, rows - files, 0, seconds))
+    engine.close()
+    for r in results:
+        r["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+def spawn(args, phase, dbfile, data):
+    command = [sys.executable, os.path.abspath(__file__), "--script", args.script, "--hashcheck-args=" + args.hashcheck_args, "--child", phase, dbfile, data]
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True)
+    return json.loads(result.stdout)
+
+def run_suite(args, work):
+    hc = load_script(args.script)
+    data = os.path.join(work, "data")
+    print("Creating tree...", file=sys.stderr)
+    make_tree(os.path.join(data, "tree"), args.tiny_files, args.huge_files, args.huge_mb, args.depth)
+
+    empty = os.path.join(work, "empty.sqlite")
+    make_db(hc, empty, 0, os.path.join(data, "ghost"))
+    results = spawn(args, "getFileList", empty, data)
+    for rows in args.rows:
+        print("{} rows...".format(rows), file=sys.stderr)
+        base = os.path.join(work, "base{}.sqlite".format(rows))
+        make_db(hc, base, rows, os.path.join(data, "ghost"))
+        results += spawn(args, "getSubset", base, data)
+        # generate adds the tree to a copy of the DB, which check and prune then work on
+        dbfile = os.path.join(work, "work{}.sqlite".format(rows))
+        shutil.copyfile(base, dbfile)
+        results += spawn(args, "generate_hashes", dbfile, data)
+        results += spawn(args, "check_hashes", dbfile, data)
+        results += spawn(args, "prune_db", dbfile, data)
+        os.remove(base)
+        os.remove(dbfile)
+    return results
+
+if __name__ == "__main__" :
+    args = parse_args()
+    extra = shlex.split(args.hashcheck_args)
+    if args.child:
+        hc = load_script(args.script)
+        with redirect_stdout(open(os.devnull, "w")):
+            results = run_child(hc, *args.child, extra)
+        print(json.dumps(results))
+        sys.exit(0)
+
+    if args.dir:
+        os.makedirs(args.dir)
+        results = run_suite(args, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as work:
+            results = run_suite(args, work)
+
+    report = {"script": args.script, "hashcheck_args": args.hashcheck_args, "cpu_count": os.cpu_count(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,37 +1,118 @@
 import hashlib
 import argparse
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
+import re
 import signal
 import sys
-from filedate.Utils import Copy
+import threading
+import time
+from stat import S_ISREG
+from collections import deque, namedtuple
+from itertools import groupby
+from contextlib import nullcontext
+# Modules only some options need (filedate for --copy-to, concurrent.futures for -j and -tree, xxhash
+# and blake3, json for --stats-file, the watch and --quick helpers) are imported where they're used,
+# so short runs don't pay for them
+
+class CopyError(OSError):
+    pass
+
+class HashCheckError(Exception):
+    # Ends a HashCheck call, the command line prints it and exits with exitcode
+    def __init__(self, message, exitcode=2):
+        super().__init__(message)
+        self.exitcode = exitcode
 
 class destination_file():
-    def __init__(self, destdir):
+    # With a queue of buffers, blocks are written by a separate thread so that reading the source
+    # and writing the destination overlap. Without, they're written synchronously.
+    def __init__(self, destdir, buffers=None, verify=False):
         self.destdir = destdir
         self.sourcepath = None
         self.destpath = None
         self.destfile = None
+        self.buffers = buffers
+        self.verify = verify
+        self.current = None
+        self.blocks = None
+        self.writer = None
+        self.error = None
     
     def open(self, filepath):
         self.sourcepath = filepath
         (drive, pathandfile) = os.path.splitdrive(filepath)
         (path, file)  = os.path.split(pathandfile)
-        if not os.path.isdir(self.destdir + path):
-            os.makedirs(self.destdir + path)
+        os.makedirs(self.destdir + path, exist_ok=True)
         self.destpath = self.destdir + pathandfile
         self.destfile = open(self.destpath, "wb")
+        if self.buffers != None:
+            import queue
+            self.blocks = queue.Queue()
+            self.writer = threading.Thread(target=self.write_blocks, daemon=True)
+            self.writer.start()
 
-    def write(self, data):
-        self.destfile.write(data)
+    def get_buffer(self, buffer):
+        # Returns the buffer to read the first block into
+        if self.writer == None:
+            return buffer
+        self.current = self.buffers.get()
+        return self.current
 
-    def close(self):
+    def write(self, buffer, length):
+        # Returns the buffer to read the next block into, blocks while the writer is a full ring behind
+        if self.writer == None:
+            self.destfile.write(buffer[:length])
+            return buffer
+        self.blocks.put((buffer, length))
+        self.current = self.buffers.get()
+        return self.current
+
+    def write_blocks(self):
+        while True:
+            block = self.blocks.get()
+            if block == None:
+                return
+            (buffer, length) = block
+            if self.error == None:
+                try:
+                    self.destfile.write(buffer[:length])
+                except OSError as e:
+                    self.error = e
+            self.buffers.put(buffer)
+
+    def close(self, complete=True):
+        if self.writer != None:
+            self.blocks.put(None)
+            self.writer.join()
+            self.buffers.put(self.current)
+            self.writer = None
+        if self.verify and complete and self.error == None:
+            self.destfile.flush()
+            os.fsync(self.destfile.fileno())
         self.destfile.close()
-        Copy(self.sourcepath, self.destpath).all()
         self.destfile = None
+        if complete:
+            if self.error != None:
+                raise CopyError(self.error)
+            from filedate.Utils import Copy
+            Copy(self.sourcepath, self.destpath).all()
 
-def parse_args():
+    def check(self, digest, algorithm, buffer):
+        # Re-reads the copy, from the disk rather than the page cache where the OS allows it
+        file_hash = new_hash(algorithm)
+        with open(self.destpath, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            length = f.readinto(buffer)
+            while length:
+                file_hash.update(buffer[:length])
+                length = f.readinto(buffer)
+        if file_hash.digest() != digest:
+            raise CopyError("Copy verification failed")
+
+def make_parser():
     parser = argparse.ArgumentParser(description="Version 1.0.2")
     mode_group = parser.add_mutually_exclusive_group(required=True)
     mode_group.add_argument("-g", "--generate", help="Generate hashes for new files in specified file/directory", action='store_true')
@@ -39,20 +120,47 @@ def parse_args():
     mode_group.add_argument("-e", "--enumerate", help="List files not present in DB", action='store_true')
     mode_group.add_argument("-m", "--missing", help="Only check for missing files (always recursively)", action='store_true')
     mode_group.add_argument("-p", "--prune", help="Prune missing files from DB (always recursively)", action='store_true')
+    mode_group.add_argument("-D", "--duplicates", help="List groups of identical files in DB (always recursively)", action='store_true')
     parser.add_argument("-r", "--recursive", help="Recursive search", action='store_true')
     parser.add_argument("-u", "--update", help="Update existing hashes", required=False, action='store_true')
     parser.add_argument("-t", "--test-run", help="Test run", action='store_true')
+    parser.add_argument("--resume", help="Continue the last interrupted --generate or --check run on the same path", action='store_true')
+    parser.add_argument("--track-moves", help="With --generate, match new files to missing ones by size, date and inode and move their DB entry instead of hashing", action='store_true')
+    parser.add_argument("--skip-unique-sizes", help="With --generate, don't hash files whose size no other file has (only for --duplicates)", action='store_true')
+    parser.add_argument("-q", "--quick", help="Skip hashing files whose size and modified date match the DB", action='store_true')
+    parser.add_argument("--fast", help="With --check, only compare a fingerprint of the size and the first, middle and last 64KB of each file", action='store_true')
+    parser.add_argument("--older-than", help="Only check files not checked in the last OLDER_THAN days, stalest first", required=False, type=float)
+    parser.add_argument("--budget", help="Stop checking after this amount of data or time (e.g. 500GB, 2TB, 90min, 6h)", required=False)
+    parser.add_argument("--verify-sample", help="With --quick, still hash this percentage of the skipped files", required=False, type=float, default=0)
     parser.add_argument('-v', '--verbose', action='count', default=0, help="verbose output (repeat for increased verbosity)")
-    parser.add_argument("-d", "--database", help="Specify database file", required=False, default="hashes.sqlite")
+    parser.add_argument("-d", "--database", help="Specify database file, or a folder of DB shards. Repeat for several", required=False, action="append")
+    parser.add_argument("--direct", help="Work directly on the DB file (WAL mode) instead of a copy in RAM", action='store_true')
+    parser.add_argument("--cache-size", help="SQLite page cache size in MB with --direct", required=False, type=int)
+    parser.add_argument("--batch-size", help="Number of DB changes written per transaction", required=False, type=int, default=1000)
     parser.add_argument("-o", "--outfile", help="Output to file", required=False)
     parser.add_argument("-s", "--session", help="Session number", required=False, type=int)
     parser.add_argument("--db-path", help="Path in DB", required=False)
     parser.add_argument("--fs-path", help="Path in filesystem", required=False)
     parser.add_argument("--path-conv-to", help="Convert slashes in paths to (u/w)", required=False)
     parser.add_argument("--copy-to", help="Copy hashed files to destination", required=False)
+    parser.add_argument("--copy-verify", help="Verify copies by reading them back from the destination", action='store_true')
+    parser.add_argument("-a", "--algorithm", help="Hash algorithm for new files, add -tree to hash large files on several cores (e.g. blake2b-tree)", required=False, default="sha256")
+    parser.add_argument("--block-size", help="Read block size in KB", required=False, type=int, default=1024)
+    parser.add_argument("--drop-cache", help="Drop hashed files from the OS page cache", action='store_true')
+    parser.add_argument("-j", "--jobs", help="Number of files hashed in parallel", required=False, type=int, default=1)
+    parser.add_argument("--jobs-per-device", help="Max files hashed in parallel on the same device", required=False, type=int, default=0)
+    parser.add_argument("--progress", help="Show progress and throughput on stderr", action='store_true')
+    parser.add_argument("--stats-file", help="Write progress and phase timings as JSON to this file", required=False)
+    parser.add_argument("--progress-interval", help="Seconds between progress updates", required=False, type=float, default=2)
+    parser.add_argument("--watch", help="With --generate, keep running and hash files as they are created or modified", action='store_true')
+    parser.add_argument("--settle", help="With --watch, seconds a file must stay unchanged before it's hashed", required=False, type=float, default=5)
+    parser.add_argument("--poll-interval", help="With --watch, seconds between rescans where inotify isn't available", required=False, type=float, default=60)
     parser.add_argument("path", help="Path")
+    return parser
 
-    args = parser.parse_args()
+def parse_args():
+    global args
+    args = make_parser().parse_args()
 
     if args.recursive and not (args.generate or args.enumerate):
         output("--recursive only available with --generate or --enumerate")
@@ -62,14 +170,76 @@ def parse_args():
         output("--update only available with --generate")
         sys.exit(1)
 
+    if args.watch and not (args.generate and os.path.isdir(args.path)):
+        output("--watch only available with --generate on a folder")
+        sys.exit(1)
+
+    if args.settle < 0 or args.poll_interval <= 0:
+        output("Invalid --settle or --poll-interval")
+        sys.exit(1)
+
+    if args.resume and not (args.generate or args.check):
+        output("--resume only available with --generate or --check")
+        sys.exit(1)
+
+    if args.track_moves and not (args.generate and not args.update):
+        output("--track-moves only available with --generate without --update")
+        sys.exit(1)
+
+    if args.skip_unique_sizes and not (args.generate and not args.update):
+        output("--skip-unique-sizes only available with --generate without --update")
+        sys.exit(1)
+
+    if args.quick and not (args.check or args.update):
+        output("--quick only available with --check or --update")
+        sys.exit(1)
+
+    if args.verify_sample != 0 and not args.quick:
+        output("--verify-sample only available with --quick")
+        sys.exit(1)
+
+    if args.verify_sample < 0 or args.verify_sample > 100:
+        output("--verify-sample is a percentage!")
+        sys.exit(1)
+
+    if args.fast and not args.check:
+        output("--fast only available with --check")
+        sys.exit(1)
+
+    if args.fast and args.resume:
+        # A fingerprint that matches isn't recorded, there's nothing to resume from
+        output("--resume not available with --fast")
+        sys.exit(1)
+
+    if (args.older_than != None or args.budget != None) and not args.check:
+        output("--older-than and --budget only available with --check")
+        sys.exit(1)
+
+    if args.budget != None:
+        args.budget = parse_budget(args.budget)
+        if args.budget == None:
+            output("Budget must be a size (MB/GB/TB) or a duration (min/h)")
+            sys.exit(1)
+
     if args.session and not args.generate:
         output("--session only available with --generate")
         sys.exit(1)
 
+    if args.database == None:
+        args.database = ["hashes.sqlite"]
+
     if bool(args.db_path != None) ^ bool(args.fs_path != None):
         output("Path substitution needs both sides!")
         sys.exit(1)
 
+    if args.batch_size < 1:
+        output("Invalid batch size!")
+        sys.exit(1)
+
+    if args.cache_size != None and not args.direct:
+        output("--cache-size only available with --direct")
+        sys.exit(1)
+
     if args.path_conv_to != None:
         if args.db_path == None:
             output("Path conversion only useful with path substitution!")
@@ -80,6 +250,28 @@ def parse_args():
             output("Path conversion to [w]indows or [u]nix")
             sys.exit(1)
 
+    if args.algorithm.lower().replace("-tree", "") not in ALGORITHMS:
+        output("Algorithm must be one of {}, optionally with -tree".format(", ".join(ALGORITHMS)))
+        sys.exit(1)
+    args.algorithm = args.algorithm.lower()
+    try:
+        new_hash(args.algorithm.replace("-tree", ""))
+    except ImportError:
+        output("Algorithm {} needs the {} module".format(args.algorithm, "blake3" if "blake3" in args.algorithm else "xxhash"))
+        sys.exit(1)
+
+    if args.block_size < 4:
+        output("Block size must be at least 4KB")
+        sys.exit(1)
+
+    if args.jobs < 1 or args.jobs_per_device < 0:
+        output("Invalid number of jobs!")
+        sys.exit(1)
+
+    if args.progress_interval <= 0:
+        output("Progress interval must be positive")
+        sys.exit(1)
+
     if args.copy_to != None:
         if not (args.generate or args.check):
             output("Copy only supported while generating or checking!")
@@ -87,287 +279,1522 @@ def parse_args():
         if os.path.abspath(args.path) in os.path.abspath(args.copy_to):
             output("Copy destination can't be inside the source folder!")
             sys.exit(1)
+        try:
+            import filedate
+        except ImportError:
+            output("--copy-to needs the filedate module")
+            sys.exit(1)
+    elif args.copy_verify:
+        output("--copy-verify only available with --copy-to")
+        sys.exit(1)
 
     return args
 
+SCHEMA_VERSION = 6
+FILES = "hashes JOIN directories ON hashes.directory = directories.id"
+TREE_CHUNK_SIZE = 16 * 1048576
+FINGERPRINT_SIZE = 64 * 1024
+ALGORITHMS = ["sha256", "sha512", "sha1", "md5", "blake2b", "blake2s", "xxh64", "xxh3_64", "xxh3_128", "blake3"]
+
+# What the HashCheck calls yield for each file. result is e.g. "added", "updated", "ok", "mismatch" or "missing",
+# size and digest are set when the file was read (the digest is the fingerprint with --fast)
+file_result = namedtuple("file_result", ["path", "result", "size", "digest"], defaults=[None, None])
+
+tree_pool = None
+tree_pool_lock = threading.Lock()
+
+class tree_hash():
+    # Hashes fixed-size chunks of a file on several threads, the digest is the hash of the chunk digests.
+    # Lets a single large file use more than one core.
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.chunk = bytearray()
+        self.pending = deque()
+        self.digests = []
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data):
+            count = min(len(data), TREE_CHUNK_SIZE - len(self.chunk))
+            self.chunk += data[:count]
+            data = data[count:]
+            if len(self.chunk) == TREE_CHUNK_SIZE:
+                self.submit()
+
+    def submit(self):
+        self.pending.append(shared_tree_pool().submit(hash_chunk, self.algorithm, self.chunk))
+        self.chunk = bytearray()
+        while len(self.pending) > (os.cpu_count() or 1) * 2:
+            self.digests.append(self.pending.popleft().result())
+
+    def digest(self):
+        if len(self.chunk) or not (self.pending or self.digests):
+            self.submit()
+        while self.pending:
+            self.digests.append(self.pending.popleft().result())
+        file_hash = new_hash(self.algorithm)
+        for digest in self.digests:
+            file_hash.update(digest)
+        return file_hash.digest()
+
+def shared_tree_pool():
+    # Created on first use, shared by all the tree_hash instances
+    global tree_pool
+    with tree_pool_lock:
+        if tree_pool == None:
+            from concurrent.futures import ThreadPoolExecutor
+            tree_pool = ThreadPoolExecutor(os.cpu_count() or 1)
+    return tree_pool
+
+def hash_chunk(algorithm, chunk):
+    chunk_hash = new_hash(algorithm)
+    chunk_hash.update(chunk)
+    return chunk_hash.digest()
+
+def new_hash(algorithm):
+    # Optional backends are only imported when used
+    if algorithm.endswith("-tree"):
+        return tree_hash(algorithm[:-5])
+    elif algorithm.startswith("xxh"):
+        import xxhash
+        return getattr(xxhash, algorithm)()
+    elif algorithm == "blake3":
+        from blake3 import blake3
+        return blake3()
+    return hashlib.new(algorithm)
+
+
+class db_writer():
+    # Accumulates INSERT/UPDATE rows and writes them with executemany, one transaction per batch.
+    # Each batch goes to every connection, the first one is where the rows are read back from
+    def __init__(self, connections, batch_size, interval, stats):
+        self.connections = connections
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stats = stats
+        self.pending = {}
+        self.count = 0
+        self.lastflush = datetime.now()
+
+    def add(self, query, row):
+        self.pending.setdefault(query, []).append(row)
+        self.count += 1
+        if self.count >= self.batch_size or (datetime.now() - self.lastflush).total_seconds() > self.interval:
+            self.flush()
+
+    def flush(self):
+        # popitem() so a flush interrupted by Ctrl-C leaves the rest for the one in terminate()
+        clock = time.perf_counter()
+        while self.pending:
+            (query, rows) = self.pending.popitem()
+            for connection in self.connections:
+                connection.executemany(query, rows)
+        for connection in self.connections:
+            connection.commit()
+        self.count = 0
+        self.lastflush = datetime.now()
+        self.stats.phase_times()["db"] += time.perf_counter() - clock
+
+class progress():
+    # Files/bytes counters for --progress and --stats-file. The main loops call done() once per file and the
+    # read loop calls read() per block, so a large file still gets reports while it's read. Either only reports
+    # when the interval has passed; output() isn't involved.
+    def __init__(self, show, stats_file, interval):
+        self.show = show
+        self.stats_file = stats_file
+        self.interval = interval
+        self.enabled = show or stats_file != None
+        self.start = time.monotonic()
+        self.next_report = self.start + interval
+        self.files_done = 0
+        self.bytes_done = 0
+        self.bytes_hashed = 0
+        self.bytes_reading = 0
+        self.files_total = None
+        self.bytes_total = None
+        self.thread_data = threading.local()
+        self.lock = threading.Lock()
+        self.all_phase_times = []
+        self.report_lock = threading.RLock()
+
+    def total(self, files, size):
+        # Added up when checking several DB shards
+        self.files_total = (self.files_total or 0) + files
+        self.bytes_total = (self.bytes_total or 0) + size
+
+    def done(self, size, hashed, read=None):
+        # read is what was actually read of the file when it's less than its size (--fast)
+        self.files_done += 1
+        self.bytes_done += size
+        if hashed:
+            self.bytes_hashed += size if read == None else read
+        if self.enabled and time.monotonic() >= self.next_report:
+            self.report()
+
+    def read(self, length, report=True):
+        # Bytes of files still being read, from the worker threads. read_hash() takes them back off
+        # before the file is counted by done()
+        if not self.enabled:
+            return
+        with self.lock:
+            self.bytes_reading += length
+        if report and time.monotonic() >= self.next_report:
+            self.report()
+
+    def phase_times(self):
+        # Per-thread stat/read/hash/db seconds, summed over all threads by snapshot()
+        if not hasattr(self.thread_data, "times"):
+            self.thread_data.times = {"stat": 0, "read": 0, "hash": 0, "db": 0}
+            with self.lock:
+                self.all_phase_times.append(self.thread_data.times)
+        return self.thread_data.times
+
+    def snapshot(self, running):
+        elapsed = time.monotonic() - self.start
+        bytes_done = self.bytes_done + self.bytes_reading
+        bytes_hashed = self.bytes_hashed + self.bytes_reading
+        eta = None
+        if self.bytes_total and bytes_done:
+            eta = (self.bytes_total - bytes_done) * elapsed / bytes_done
+        elif self.files_total and self.files_done:
+            eta = (self.files_total - self.files_done) * elapsed / self.files_done
+        return {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "running": running,
+            "elapsed": round(elapsed, 3),
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "bytes_done": bytes_done,
+            "bytes_total": self.bytes_total,
+            "bytes_hashed": bytes_hashed,
+            "mb_per_s": round(bytes_hashed / 1048576 / elapsed, 1) if elapsed > 0 else 0,
+            "files_per_s": round(self.files_done / elapsed, 1) if elapsed > 0 else 0,
+            "eta": round(eta) if eta != None else None,
+            # Summed over all threads, so with -j they can add up to more than the elapsed time
+            "phases": {name: round(sum(times[name] for times in self.all_phase_times), 3) for name in ["stat", "read", "hash", "db"]},
+        }
+
+    def report(self, running=True):
+        # Worker threads report too, one at a time and only once per interval
+        with self.report_lock:
+            if running and time.monotonic() < self.next_report:
+                return
+            self.write_report(running)
+
+    def write_report(self, running):
+        stats = self.snapshot(running)
+        if self.show:
+            files = "{}/{}".format(stats["files_done"], stats["files_total"]) if stats["files_total"] != None else str(stats["files_done"])
+            size = "{:.1f}/{:.1f}".format(stats["bytes_done"] / 1073741824, stats["bytes_total"] / 1073741824) if stats["bytes_total"] != None else "{:.1f}".format(stats["bytes_done"] / 1073741824)
+            eta = ", ETA {}".format(timedelta(seconds=stats["eta"])) if stats["eta"] != None else ""
+            print("{} files, {} GB, {} MB/s, {} files/s{}".format(files, size, stats["mb_per_s"], stats["files_per_s"], eta), file=sys.stderr)
+        if self.stats_file != None:
+            import json
+            # Written aside then renamed so a reader never sees a partial file
+            with open(self.stats_file + ".tmp", "w") as f:
+                json.dump(stats, f)
+            os.replace(self.stats_file + ".tmp", self.stats_file)
+        self.next_report = time.monotonic() + self.interval
+
+def parse_budget(budget):
+    # Returns (bytes, None) or (None, seconds)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(mb|gb|tb|min|h)\s*", budget.lower())
+    if not match:
+        return None
+    amount = float(match.group(1))
+    unit = match.group(2)
+    if unit == "min":
+        return (None, amount * 60)
+    elif unit == "h":
+        return (None, amount * 3600)
+    return (amount * 1024 ** ["mb", "gb", "tb"].index(unit) * 1048576, None)
+
 def output(string, to_stdout = 0, to_file = None):
     if args.verbose >= to_stdout:
         print(string)
     if to_file != None and args.verbose >= to_file and outfile != None:
         print(string, file=outfile)
 
-def getFileList(path, recursive):
-    output("Listing files and folders...")
-    filelist = []
+def scan_folders(path, recursive):
+    # Depth-first, each folder's files sorted and yielded before its subfolders. Like os.walk,
+    # unreadable folders are skipped and symlinked folders aren't followed
+    stack = [path]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subfolders = []
+        for entry in entries:
+            # Only regular files (or links to one), a FIFO or device node would block or never end when read
+            try:
+                (is_file, is_dir) = (entry.is_file(), entry.is_dir())
+            except OSError:
+                (is_file, is_dir) = (False, False)
+            if is_file:
+                yield entry.path
+            elif is_dir and recursive and not entry.is_symlink():
+                subfolders.append(entry.path)
+        stack.extend(reversed(subfolders))
+
+class path_translation():
+    # --db-path/--fs-path/--path-conv-to: paths are mapped one by one where the DB is queried or its rows
+    # compared with the file system, the DB itself is never rewritten
+    def __init__(self, db_path, fs_path, conv_to):
+        self.db_path = db_path
+        self.fs_path = fs_path
+        if conv_to == "w":
+            (self.db_sep, self.fs_sep) = ("/", "\\")
+        elif conv_to == "u":
+            (self.db_sep, self.fs_sep) = ("\\", "/")
+        else:
+            (self.db_sep, self.fs_sep) = (None, None)
+
+    def to_fs(self, path):
+        return self.translate(path, self.db_path, self.fs_path, self.db_sep, self.fs_sep)
+
+    def to_db(self, path):
+        return self.translate(path, self.fs_path, self.db_path, self.fs_sep, self.db_sep)
+
+    def translate(self, path, prefix, replacement, sep, new_sep):
+        if prefix == None or not path.startswith(prefix):
+            return path
+        rest = path[len(prefix):]
+        if sep != None:
+            rest = rest.replace(sep, new_sep)
+        return replacement + rest
+
+def split_path(filepath):
+    # (folder with its trailing separator, file name). Either separator counts so paths from the other OS split too
+    i = max(filepath.rfind("/"), filepath.rfind("\\"))
+    return (filepath[:i + 1], filepath[i + 1:])
+
+def shard_files(schema):
+    return "{0}.hashes AS hashes JOIN {0}.directories AS directories ON hashes.directory = directories.id".format(schema)
+
+def path_range(path, paths):
+    # (lower, upper) bounds of the DB folder paths under path, None if it doesn't exist
     if os.path.isfile(path):
-        filelist = [path]
+        lower = split_path(paths.to_db(path))[0]
+        return (lower, lower + "\0")
     elif os.path.isdir(path):
-        for (dirpath, dirnames, filenames) in os.walk(path):
-            for f in filenames:
-                filelist.append(os.path.join(dirpath, f))
-            if not recursive:
+        lower = paths.to_db(path if path[-1] == os.sep else path + os.sep)
+        return (lower, lower[:-1] + chr(ord(lower[-1]) + 1))
+    return None
+
+class fingerprint():
+    # Hash of the size and the first, middle and last FINGERPRINT_SIZE bytes of a file, collected from
+    # the blocks read for the full hash
+    def __init__(self, size):
+        self.size = size
+        self.regions = [(offset, bytearray(min(FINGERPRINT_SIZE, size))) for offset in fingerprint_offsets(size)]
+
+    def update(self, position, data):
+        end = position + len(data)
+        for (offset, region) in self.regions:
+            if offset < end and position < offset + len(region):
+                start = max(offset, position)
+                stop = min(offset + len(region), end)
+                region[start - offset:stop - offset] = data[start - position:stop - position]
+
+    def digest(self):
+        return fingerprint_digest(self.size, [region for (offset, region) in self.regions])
+
+def fingerprint_offsets(size):
+    length = min(FINGERPRINT_SIZE, size)
+    return [0, (size - length) // 2, size - length]
+
+def fingerprint_digest(size, regions):
+    fingerprint_hash = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=16)
+    for region in regions:
+        fingerprint_hash.update(region)
+    return fingerprint_hash.digest()
+
+def open_regular(filepath):
+    # Opens filepath unbuffered, returns (file, stat). Non-blocking so opening a FIFO doesn't wait for a writer,
+    # anything that isn't a regular file is refused
+    fd = os.open(filepath, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0) | getattr(os, "O_BINARY", 0))
+    try:
+        stat = os.fstat(fd)
+        if not S_ISREG(stat.st_mode):
+            raise OSError("Not a regular file: {}".format(filepath))
+    except BaseException:
+        os.close(fd)
+        raise
+    return (os.fdopen(fd, "rb", buffering=0), stat)
+
+def read_fingerprint(filepath, times=None):
+    # Returns (fingerprint, size, stat, bytes read) reading only the fingerprint regions.
+    # times gets the stat/read/hash seconds like in read_hash()
+    if times == None:
+        times = {"stat": 0, "read": 0, "hash": 0}
+    clock = time.perf_counter()
+    (f, stat) = open_regular(filepath)
+    with f:
+        now = time.perf_counter()
+        times["stat"] += now - clock
+        regions = []
+        for offset in fingerprint_offsets(stat.st_size):
+            f.seek(offset)
+            regions.append(f.read(min(FINGERPRINT_SIZE, stat.st_size)))
+        clock = time.perf_counter()
+        times["read"] += clock - now
+    digest = fingerprint_digest(stat.st_size, regions)
+    times["hash"] += time.perf_counter() - clock
+    return (digest, stat.st_size, stat, sum(len(region) for region in regions))
+
+class inotify_watcher():
+    # Linux change events through inotify, with one watch per folder
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, path, recursive, output):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.path = path
+        self.recursive = recursive
+        self.output = output
+        self.folders = {}
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.add(path)
+        self.since = time.time_ns()
+
+    def add(self, path):
+        # path and, if recursive, all its subfolders
+        stack = [path]
+        while stack:
+            folder = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                error = self.ctypes.get_errno()
+                if folder == self.path:
+                    raise OSError(error, "inotify_add_watch failed")
+                self.output("Unable to watch {}: {}".format(folder, os.strerror(error)), 0, 0)
+                continue
+            self.folders[wd] = folder
+            if self.recursive:
+                try:
+                    with os.scandir(folder) as it:
+                        stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+                except OSError:
+                    pass
+
+    def changes(self, timeout):
+        # Files created, written or moved in since the last call, waiting up to timeout seconds for the first event
+        import select
+        import struct
+        select.select([self.fd], [], [], timeout)
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except BlockingIOError:
                 break
-    else:
-        output("Invalid path! {}".format(path))
-        terminate(2)
+            if not chunk:
+                break
+            data += chunk
+        changed = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.output("Too many changes at once, rescanning {}".format(self.path), 0, 0)
+                changed += changed_since(self.path, self.recursive, self.since)
+            elif mask & self.IN_IGNORED:
+                self.folders.pop(wd, None)
+            elif wd in self.folders:
+                path = os.path.join(self.folders[wd], name)
+                if not mask & self.IN_ISDIR:
+                    changed.append(path)
+                elif self.recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # Files may already be in a new folder before its watch is added
+                    self.add(path)
+                    changed += scan_folders(path, True)
+        if data:
+            self.since = time.time_ns()
+        return changed
 
-    return filelist
+    def close(self):
+        os.close(self.fd)
 
-def getFilter(path):
-    if os.path.isfile(path):
-        filter = path
-    elif os.path.isdir(path):
-        if(path[-1] != os.sep):
-            filter = path + os.sep + "%"
+class poll_watcher():
+    # Fallback where inotify isn't available: rescans for files created or changed since the previous scan
+    def __init__(self, path, recursive, interval):
+        self.path = path
+        self.recursive = recursive
+        self.interval = interval
+        self.since = time.time_ns()
+        self.next_scan = time.monotonic() + interval
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        if time.monotonic() < self.next_scan:
+            return []
+        since = time.time_ns()
+        changed = list(changed_since(self.path, self.recursive, self.since))
+        self.since = since
+        self.next_scan = time.monotonic() + self.interval
+        return changed
+
+    def close(self):
+        pass
+
+def changed_since(path, recursive, since_ns):
+    # ctime too, moving a file in keeps its modified date
+    for f in scan_folders(path, recursive):
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+        if max(stat.st_mtime_ns, stat.st_ctime_ns) >= since_ns:
+            yield f
+
+def create_schema(db):
+    # Each folder path is stored once, rows only keep the file name, a binary digest and integer nanosecond times.
+    # The files view shows them the v1 way for external tools.
+    db.execute("CREATE TABLE directories(id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)")
+    db.execute("CREATE TABLE hashes(id INTEGER PRIMARY KEY, directory INTEGER NOT NULL REFERENCES directories(id), name TEXT NOT NULL, digest BLOB NOT NULL, algorithm TEXT NOT NULL, filesize INTEGER, creation_ns INTEGER, modified_ns INTEGER, timestamp_ns INTEGER, session INTEGER, last_checked_ns INTEGER, last_result TEXT, UNIQUE(directory, name))")
+    db.execute("CREATE VIEW files AS SELECT hashes.id, directories.path || hashes.name AS filename, lower(hex(digest)) AS digest, algorithm, filesize, "
+        "datetime(creation_ns / 1000000000, 'unixepoch', 'localtime') AS creation_date, datetime(modified_ns / 1000000000, 'unixepoch', 'localtime') AS modified_date, "
+        "datetime(timestamp_ns / 1000000000, 'unixepoch') AS timestamp, session, datetime(last_checked_ns / 1000000000, 'unixepoch') AS last_checked, last_result FROM " + FILES)
+    db.execute("PRAGMA user_version = 2")
+
+def datetime_ns(value, utc):
+    # v1 stored str(datetime), local time for the file dates and UTC for timestamps
+    if value == None:
+        return None
+    date = datetime.fromisoformat(value)
+    if utc:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.replace(microsecond=0).timestamp()) * 1000000000 + date.microsecond * 1000
+
+def convert_v1_rows(db, rows):
+    directories = {}
+    for (filename, sha256, algorithm, filesize, created, modified, timestamp, session, last_checked, last_result) in rows:
+        (folder, name) = split_path(filename)
+        if folder not in directories:
+            directories[folder] = db.execute("INSERT INTO directories (path) VALUES (?)", (folder,)).lastrowid
+        yield (directories[folder], name, bytes.fromhex(sha256), algorithm or "sha256", filesize, datetime_ns(created, False), datetime_ns(modified, False), datetime_ns(timestamp, True), session, datetime_ns(last_checked, True), last_result)
+
+def migrate_v1(db, output):
+    output("Upgrading DB to schema v2...")
+    columns = [row[1] for row in db.execute("PRAGMA table_info(hashes)")]
+    select = ", ".join(c if c in columns else "NULL" for c in ["filename", "sha256", "algorithm", "filesize", "creation_date", "modified_date", "timestamp", "session", "last_checked", "last_result"])
+    db.execute("ALTER TABLE hashes RENAME TO hashes_v1")
+    create_schema(db)
+    # By id so the latest row of a path duplicated in old DBs wins
+    rows = db.execute("SELECT " + select + " FROM hashes_v1 ORDER BY id")
+    db.executemany("INSERT OR REPLACE INTO hashes (directory, name, digest, algorithm, filesize, creation_ns, modified_ns, timestamp_ns, session, last_checked_ns, last_result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", convert_v1_rows(db, rows))
+    db.execute("DROP TABLE hashes_v1")
+    db.commit()
+    db.execute("VACUUM")
+
+def upgrade_db(db, output=lambda string, to_stdout=0, to_file=None: None):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise HashCheckError("DB was created by a newer version")
+    if version < 2:
+        if db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='hashes'").fetchone():
+            migrate_v1(db, output)
         else:
-            filter = path + "%"
-    else:
-        filter = "%"
+            create_schema(db)
+    if version < 3:
+        # Inode for --track-moves
+        db.execute("ALTER TABLE hashes ADD COLUMN inode INTEGER")
+        db.execute("PRAGMA user_version = 3")
+    if version < 4:
+        # Generate/check runs for --resume
+        db.execute("CREATE TABLE runs(id INTEGER PRIMARY KEY, mode TEXT NOT NULL, path TEXT NOT NULL, started_ns INTEGER NOT NULL, finished_ns INTEGER)")
+        db.execute("PRAGMA user_version = 4")
+    if version < 5:
+        # Partial-content fingerprint for --check --fast
+        db.execute("ALTER TABLE hashes ADD COLUMN fingerprint BLOB")
+        db.execute("PRAGMA user_version = 5")
+    if version < 6:
+        # Root folder of a shard, the DB path prefix it holds
+        db.execute("CREATE TABLE shard(root TEXT NOT NULL)")
+        db.execute("PRAGMA user_version = 6")
+    db.execute("CREATE INDEX IF NOT EXISTS hashes_digest ON hashes(digest)")
+    if os.name == "nt":
+        db.execute("CREATE INDEX IF NOT EXISTS directories_path_nocase ON directories(path COLLATE NOCASE)")
 
-    return filter
+class HashCheck():
+    # Works on one DB file with the given config (see options()), owning its connections and worker
+    # state, so a long-running process can keep it open and reuse the loaded DB across calls.
+    # generate(), check(), enumerate(), missing(), prune() and duplicates() yield a file_result per file,
+    # messages go to the output function (same arguments as output(), none by default).
+    def __init__(self, dbfile, args=None, output=None, stats=None):
+        self.args = args if args != None else options()
+        self.log = output
+        self.stats = stats if stats != None else progress(False, None, self.args.progress_interval)
+        if self.args.copy_to != None and os.path.isdir(os.path.abspath(self.args.copy_to)):
+            self.destpath = os.path.abspath(self.args.copy_to)
+        else:
+            self.destpath = None
+        self.device_semaphores = {}
+        self.device_lock = threading.Lock()
+        self.thread_data = threading.local()
+        self.remap = path_translation(self.args.db_path, self.args.fs_path, self.args.path_conv_to)
+        self.paths = self.remap
+        self.mode = None
+        self.run_id = None
+        self.run_resumed = None
+        self.open_db(dbfile)
 
-def getSubset(abspath, new, recursive):
-    filelist = getFileList(abspath, recursive)
-    filter = getFilter(abspath)
-    crsr = mem_db.cursor()
-    crsr.execute("SELECT filename FROM hashes WHERE filename LIKE ?", (filter,))
-    dbresults = crsr.fetchall()
-    try:
-        dblist = list(zip(*dbresults))[0]
-    except IndexError:
-        dblist = []
+    def output(self, string, to_stdout=0, to_file=None):
+        if self.log != None:
+            self.log(string, to_stdout, to_file)
 
-    if new:
-        files = list(set(filelist) - set(dblist))
-    else:
-        files = list(set(dblist) - set(filelist))
+    def open_db(self, dbfile):
+        self.dbfile = dbfile
+        try:
+            self.db = sqlite3.connect(dbfile)
+            upgrade_db(self.db, self.output)
+        except sqlite3.DatabaseError:
+            raise HashCheckError("Invalid DB file")
+        self.db.commit()
+
+        if self.args.direct:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            if self.args.cache_size != None:
+                self.db.execute("PRAGMA cache_size={}".format(-self.args.cache_size * 1024))
+            self.mem_db = self.db
+        else:
+            self.mem_db = sqlite3.connect(":memory:")
+            self.db.backup(self.mem_db)
 
-    return sorted(files)
+        self.writer = db_writer([self.mem_db], self.args.batch_size, 10, self.stats)
+        self.directory_ids = {}
+        self.shards = ["main"]
 
-def hash_file(filepath):
-    if destfile:
-        destfile.open(filepath)
+    def attach(self, dbfiles):
+        # Other shards, queried together with this DB by enumerate(), missing() and duplicates()
+        for dbfile in dbfiles:
+            # Upgraded first like the DB itself, an old shard doesn't have the tables queried
+            try:
+                shard = sqlite3.connect(dbfile)
+                upgrade_db(shard, self.output)
+                shard.commit()
+                shard.close()
+            except sqlite3.DatabaseError:
+                raise HashCheckError("Invalid DB file {}".format(dbfile))
+            schema = "shard{}".format(len(self.shards) - 1)
+            self.mem_db.execute("ATTACH DATABASE ? AS " + schema, (dbfile,))
+            self.shards.append(schema)
 
-    try:
-        with open(filepath,"rb") as f: 
-            file_hash = hashlib.sha256()
-            chunk = f.read(1048576)
-            while chunk:
-                file_hash.update(chunk)
+    def set_shard_root(self, root):
+        # For a new shard, saved with the rows of the next generate() call
+        self.mem_db.execute("DELETE FROM shard")
+        self.mem_db.execute("INSERT INTO shard (root) VALUES (?)", (root,))
+
+    def close(self):
+        # An interrupted call is ended first, saving what it did
+        if self.mode != None:
+            self.end(False)
+        self.db.close()
+        if self.mem_db != self.db:
+            self.mem_db.close()
+
+    def generate(self, path):
+        return self.call("update" if self.args.update else "generate", path, self.generate_files)
+
+    def check(self, path):
+        # Fast checks are runs of their own, a full check doesn't resume from one
+        return self.call("fast" if self.args.fast else "check", path, lambda abspath: self.check_hashes(self.getFilter(abspath)))
+
+    def enumerate(self, path):
+        return self.call("enumerate", path, lambda abspath: self.list_subset(abspath, True, self.args.recursive))
+
+    def missing(self, path):
+        return self.call("missing", path, lambda abspath: self.list_subset(abspath, False, True))
+
+    def prune(self, path):
+        return self.call("prune", path, self.prune_db)
+
+    def duplicates(self, path):
+        return self.call("duplicates", path, lambda abspath: self.find_duplicates(self.getFilter(abspath)))
+
+    def call(self, mode, path, results):
+        # Generator around one of the calls above, results(abspath) does the work once begin() has run
+        abspath = os.path.abspath(path)
+        self.begin(mode, abspath)
+        complete = False
+        try:
+            yield from results(abspath)
+            complete = True
+        finally:
+            # Already done if close() ended the call
+            if self.mode != None:
+                self.end(complete)
+
+    def begin(self, mode, abspath):
+        if self.mode != None:
+            raise HashCheckError("Another call is in progress")
+        if mode == "fast" and self.args.resume:
+            raise HashCheckError("--resume not available with --fast")
+        self.mode = mode
+        # Generated and pruned paths are the ones of this machine, the remapping is for checking and listing
+        if mode in ["generate", "update", "prune"]:
+            self.paths = path_translation(None, None, None)
+        else:
+            self.paths = self.remap
+        if mode in ["check", "fast"] and self.mem_db != self.db:
+            # Check results go straight to the file DB, which isn't saved as a whole in check mode,
+            # and to mem_db so that later calls see them
+            self.writer = db_writer([self.db, self.mem_db], self.args.batch_size, 10, self.stats)
+        else:
+            self.writer = db_writer([self.mem_db], self.args.batch_size, 10, self.stats)
+        self.run_id = None
+        self.run_resumed = None
+        if mode in ["generate", "update", "check", "fast"] and not self.args.test_run:
+            (self.run_id, self.run_resumed) = self.start_run(mode, abspath)
+
+    def end(self, complete):
+        if self.run_id != None and complete:
+            self.writer.add("UPDATE runs SET finished_ns=? WHERE id=?", (time.time_ns(), self.run_id))
+        if self.mode in ["generate", "update", "prune"]:
+            self.save_db()
+        elif self.mode in ["check", "fast"] and not self.args.test_run:
+            self.writer.flush()
+        self.mode = None
+
+    def start_run(self, mode, path):
+        # Returns (run id, start time of the resumed run or None). The run is recorded on the connection the
+        # results go to, so in generate mode it's saved together with the rows it covers
+        connections = self.writer.connections
+        if self.args.resume:
+            row = connections[0].execute("SELECT id, started_ns, finished_ns FROM runs WHERE mode = ? AND path = ? ORDER BY id DESC LIMIT 1", (mode, path)).fetchone()
+            if row != None and row[2] == None:
+                self.output("Resuming run started {}".format(datetime.fromtimestamp(row[1] / 1e9).replace(microsecond=0)))
+                return row[:2]
+            self.output("No interrupted run to resume, starting over")
+        id = connections[0].execute("INSERT INTO runs (mode, path, started_ns) VALUES (?, ?, ?)", (mode, path, time.time_ns())).lastrowid
+        for connection in connections[1:]:
+            connection.execute("INSERT INTO runs (id, mode, path, started_ns) VALUES (?, ?, ?, ?)", (id, mode, path, time.time_ns()))
+        for connection in connections:
+            connection.commit()
+        return (id, None)
+
+    def getFileList(self, path, recursive):
+        # Generator, files are yielded as folders get listed so hashing can start right away
+        self.output("Listing files and folders...")
+        if os.path.isfile(path):
+            yield path
+        elif os.path.isdir(path):
+            yield from scan_folders(path, recursive)
+        else:
+            raise HashCheckError("Invalid path! {}".format(path))
+
+    def directory_id(self, path):
+        if path not in self.directory_ids:
+            row = self.mem_db.execute("SELECT id FROM directories WHERE path = ?", (path,)).fetchone()
+            if row == None:
+                self.directory_ids[path] = self.mem_db.execute("INSERT INTO directories (path) VALUES (?)", (path,)).lastrowid
+            else:
+                self.directory_ids[path] = row[0]
+        return self.directory_ids[path]
+
+    def select_all(self, columns, filter):
+        # The same SELECT on the DB and every attached shard
+        (clause, params) = filter
+        query = " UNION ALL ".join("SELECT {} FROM {} WHERE {}".format(columns, shard_files(schema), clause) for schema in self.shards)
+        return (query, tuple(params) * len(self.shards))
+
+    def getFilter(self, path):
+        # Returns (where clause, parameters) on FILES selecting the rows under path, as a range on the folder index
+        if os.name == "nt":
+            collate = " COLLATE NOCASE"
+        else:
+            collate = ""
+
+        if os.path.isfile(path):
+            filter = ("directories.path{0} = ? AND hashes.name{0} = ?".format(collate), split_path(self.paths.to_db(path)))
+        elif os.path.isdir(path):
+            filter = ("directories.path{0} >= ? AND directories.path{0} < ?".format(collate), path_range(path, self.paths))
+        else:
+            filter = ("1", ())
+
+        return filter
+
+    def getSubset(self, abspath, new, recursive):
+        filelist = self.getFileList(abspath, recursive)
+        if new:
+            # Streamed in scan order, the caller consumes it while the tree is still being listed
+            return self.new_files(filelist)
+        else:
+            # The scan goes to a temp table and SQLite returns the rows without a file, sorted
+            self.scan_to_temp(filelist)
+            (query, params) = self.missing_rows("directories.path || hashes.name", self.getFilter(abspath))
+            return (self.paths.to_fs(row[0]) for row in self.mem_db.execute(query + " ORDER BY 1", params))
+
+    def new_files(self, filelist):
+        # The scan lists a folder's files together, only that folder's names in the DB are held at a time
+        for (folder, files) in groupby(filelist, lambda f: split_path(f)[0]):
+            known = set(row[0] for row in self.mem_db.execute(*self.select_all("hashes.name", ("directories.path = ?", (self.paths.to_db(folder),)))))
+            for f in files:
+                if split_path(f)[1] not in known:
+                    yield f
+
+    def scan_to_temp(self, filelist):
+        self.mem_db.execute("DROP TABLE IF EXISTS temp.scanned")
+        self.mem_db.execute("CREATE TEMP TABLE scanned(path TEXT, name TEXT, PRIMARY KEY(path, name)) WITHOUT ROWID")
+        self.mem_db.executemany("INSERT OR IGNORE INTO temp.scanned VALUES (?, ?)", (split_path(self.paths.to_db(f)) for f in filelist))
+
+    def missing_rows(self, columns, filter):
+        # SELECT of the rows under filter that scan_to_temp() didn't find
+        (clause, params) = filter
+        return self.select_all(columns, (clause + " AND NOT EXISTS (SELECT 1 FROM temp.scanned WHERE scanned.path = directories.path AND scanned.name = hashes.name)", params))
+
+    def list_subset(self, abspath, new, recursive):
+        text = "New file:" if new else "File missing:"
+        for f in self.getSubset(abspath, new, recursive):
+            self.output("{} {}".format(text, f), 0, 0)
+            yield file_result(f, "new" if new else "missing")
+
+    def read_hash(self, filepath, algorithm):
+        # Returns (digest, size, stat, fingerprint) using a single fstat on the open file. size is the number of bytes
+        # actually hashed, which is what gets recorded even if the file changes while being read
+        # Unbuffered so readinto() fills the thread's reused buffer directly, no allocation or copy per chunk
+        times = self.stats.phase_times()
+        clock = time.perf_counter()
+        (f, stat) = open_regular(filepath)
+        with f:
+            times["stat"] += time.perf_counter() - clock
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_NOREUSE)
+            with self.device_semaphore(stat.st_dev):
+                file_hash = new_hash(algorithm)
+                file_fingerprint = fingerprint(stat.st_size)
+                size = 0
+                buffer = self.read_buffer()
+                if self.destpath:
+                    # Files that fit in one block aren't worth a writer thread
+                    if stat.st_size > len(buffer):
+                        destfile = destination_file(self.destpath, self.copy_buffers(), self.args.copy_verify)
+                    else:
+                        destfile = destination_file(self.destpath, None, self.args.copy_verify)
+                    destfile.open(filepath)
+                    buffer = destfile.get_buffer(buffer)
+                else:
+                    destfile = None
+
+                try:
+                    clock = time.perf_counter()
+                    length = f.readinto(buffer)
+                    while length:
+                        now = time.perf_counter()
+                        times["read"] += now - clock
+                        file_hash.update(buffer[:length])
+                        file_fingerprint.update(size, buffer[:length])
+                        size += length
+                        self.stats.read(length)
+                        clock = time.perf_counter()
+                        times["hash"] += clock - now
+                        if destfile:
+                            buffer = destfile.write(buffer, length)
+                        length = f.readinto(buffer)
+                    now = time.perf_counter()
+                    times["read"] += now - clock
+                    digest = file_hash.digest()
+                    times["hash"] += time.perf_counter() - now
+                except BaseException:
+                    if destfile:
+                        destfile.close(False)
+                    raise
+                finally:
+                    self.stats.read(-size, False)
                 if destfile:
-                    destfile.write(chunk)
-                chunk = f.read(1048576)
-            f.close()
-            if destfile:
-                destfile.close()
-        return file_hash.hexdigest()
-
-    except (PermissionError, OSError):
-        output("Unable to open file {}".format(filepath), 0, 0)
-
-def generate_hashes(filelist, update):
-    lastsave = datetime.now()
-    crsr = mem_db.cursor()
-    prevdir = ""
-    crsr.execute("SELECT filename, sha256 FROM hashes")
-    dbresults = crsr.fetchall()
-    try:
-        dblist = list(zip(*dbresults))[0]
-    except IndexError:
-        dblist = []
-        
-    if update:
+                    destfile.close()
+                    if self.args.copy_verify:
+                        destfile.check(digest, algorithm, self.read_buffer())
+            if self.args.drop_cache and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        # No fingerprint if the file didn't have the size it had when opened
+        return (digest, size, stat, file_fingerprint.digest() if size == stat.st_size else None)
+
+    def read_buffer(self):
+        # One preallocated buffer per worker thread, reused for every chunk of every file
+        if not hasattr(self.thread_data, "buffer"):
+            self.thread_data.buffer = memoryview(bytearray(self.args.block_size * 1024))
+        return self.thread_data.buffer
+
+    def copy_buffers(self):
+        # Ring of buffers per worker thread shared by the source reads and the destination writer thread
+        if not hasattr(self.thread_data, "copy_buffers"):
+            import queue
+            self.thread_data.copy_buffers = queue.Queue()
+            for i in range(4):
+                self.thread_data.copy_buffers.put(memoryview(bytearray(self.args.block_size * 1024)))
+        return self.thread_data.copy_buffers
+
+    def device_semaphore(self, dev):
+        # One semaphore per st_dev so a single (spinning) disk doesn't get more than --jobs-per-device readers
+        if self.args.jobs_per_device == 0:
+            return nullcontext()
+        with self.device_lock:
+            if dev not in self.device_semaphores:
+                self.device_semaphores[dev] = threading.BoundedSemaphore(self.args.jobs_per_device)
+            return self.device_semaphores[dev]
+
+    def hash_job(self, filepath, algorithm):
+        # Runs in a worker thread: no output() or DB access here, errors are reported by the caller.
+        # algorithm None only reads the fingerprint (--fast)
+        try:
+            if algorithm == None:
+                return (read_fingerprint(filepath, self.stats.phase_times()), None)
+            return (self.read_hash(filepath, algorithm), None)
+        except (PermissionError, OSError, ImportError) as e:
+            return (None, e)
+
+    def prefetch_hashes(self, items, wanted, key):
+        # Yields (item, future) in order while up to --jobs files ahead are hashed in worker threads.
+        # key(item) gives the (filepath, algorithm) to hash.
+        # future is None when the item isn't wanted or when running single-threaded.
+        if self.args.jobs == 1:
+            for item in items:
+                yield (item, None)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+        window = deque()
+        pool = ThreadPoolExecutor(self.args.jobs)
         try:
-            hashlist = list(zip(*dbresults))[1]
-        except IndexError:
-            hashlist = []
-
-    for f in filelist:
-        timediff = datetime.now() - lastsave
-        if timediff.total_seconds() > 300:
-            save_db()
-            if outfile != None:
-                outfile.flush()
-            lastsave = datetime.now()
-
-        dir = os.path.dirname(f)
-        if dir != prevdir:
-            prevdir = dir
-            output("Processing folder {}".format(prevdir))
-        
-        if f not in dblist:
-            if not args.test_run:
-                output("Hashing {}".format(f), 1, 2)
-                if os.path.isfile(f):
-                    hash = hash_file(f)
-                    if hash != None:
-                        createdstr = datetime.fromtimestamp(os.path.getctime(f))
-                        modifiedstr = datetime.fromtimestamp(os.path.getmtime(f))
-                        mem_db.execute("INSERT INTO hashes VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)", (f, hash, os.path.getsize(f), createdstr, modifiedstr, datetime.utcnow(), args.session))
-                        mem_db.commit()
+            for item in items:
+                if wanted(item):
+                    window.append((item, pool.submit(self.hash_job, *key(item))))
                 else:
-                    output("File was deleted: {}".format(f), 0, 0)
+                    window.append((item, None))
+                if len(window) > self.args.jobs * 4:
+                    yield window.popleft()
+            while window:
+                yield window.popleft()
+        finally:
+            for (item, future) in window:
+                if future != None:
+                    future.cancel()
+            pool.shutdown()
+
+    def collect_hash(self, filepath, algorithm, future):
+        # Returns (result, error) for filepath, hashing it now if it wasn't prefetched
+        if future == None:
+            return self.hash_job(filepath, algorithm)
+        return future.result()
+
+    def report_error(self, filepath, error, missing_text):
+        if isinstance(error, FileNotFoundError):
+            self.output("{} {}".format(missing_text, filepath), 0, 0)
+            return "missing"
+        if isinstance(error, CopyError):
+            self.output("Copy failed for {}: {}".format(filepath, error), 0, 0)
+            return "copy failed"
+        if isinstance(error, ImportError):
+            # Stored with an algorithm whose module isn't installed here (xxhash, blake3)
+            self.output("Unsupported algorithm for {}: {}".format(filepath, error), 0, 0)
+            return "unsupported algorithm"
+        self.output("Unable to open file {}".format(filepath), 0, 0)
+        return "unreadable"
+
+    def metadata_unchanged(self, filepath, filesize, modified_ns):
+        # With --quick, a file whose size and modified date match the DB is trusted without being read,
+        # except for the random --verify-sample share that still gets fully hashed
+        if not self.args.quick:
+            return False
+        clock = time.perf_counter()
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        finally:
+            self.stats.phase_times()["stat"] += time.perf_counter() - clock
+        # Within 1us, rows upgraded from schema v1 only kept microseconds
+        if stat.st_size != filesize or modified_ns == None or abs(stat.st_mtime_ns - modified_ns) >= 1000:
+            return False
+        if self.args.verify_sample == 0:
+            return True
+        import random
+        return random.uniform(0, 100) >= self.args.verify_sample
+
+    def generate_files(self, abspath):
+        # Watching starts before the first pass so nothing changed during it is missed
+        watcher = self.start_watch(abspath) if self.args.watch else None
+        try:
+            if not self.args.update:
+                filelist = self.getSubset(abspath, True, self.args.recursive)
             else:
-                output("Hashing skipped {}".format(f), 0, 0)
+                filelist = self.getFileList(abspath, self.args.recursive)
+            moves = deque()
+            if self.args.track_moves:
+                filelist = self.track_moves(abspath, filelist, moves)
+            if self.args.skip_unique_sizes:
+                filelist = self.shared_size_files(filelist)
+            for result in self.generate_hashes(filelist, self.args.update, self.run_resumed):
+                while moves:
+                    yield moves.popleft()
+                yield result
+            yield from moves
+            if watcher != None:
+                yield from self.watch(abspath, watcher)
+        finally:
+            if watcher != None:
+                watcher.close()
 
-        else:
+    def indexed_files(self, filelist, update):
+        # Yields (file, its DB row or None). Without update the list only has new files (see new_files()), with it
+        # the rows are read one folder at a time like new_files() does
+        for (folder, files) in groupby(filelist, lambda f: split_path(f)[0]):
+            rows = {}
             if update:
-                index = dblist.index(f)
-                oldhash = hashlist[index]
-                
-                if os.path.isfile(f):
-                    hash = hash_file(f)
-                    if hash != oldhash:
-                        if not args.test_run:
-                            output("Updating file {}".format(f), 0, 0)
-                            createdstr = datetime.fromtimestamp(os.path.getctime(f))
-                            modifiedstr = datetime.fromtimestamp(os.path.getmtime(f))
-                            mem_db.execute("UPDATE hashes SET sha256=?, filesize=?, creation_date=?, modified_date=?, timestamp=?, session=? WHERE filename=?", (hash, os.path.getsize(f), createdstr, modifiedstr, datetime.utcnow(), args.session, f))
-                            mem_db.commit()
+                for row in self.mem_db.execute("SELECT hashes.name, hashes.id, digest, filesize, modified_ns, algorithm, timestamp_ns, last_checked_ns FROM " + FILES + " WHERE directories.path = ?", (self.paths.to_db(folder),)):
+                    rows[row[0]] = row[1:]
+            for f in files:
+                yield (f, rows.get(split_path(f)[1]))
+
+    def generate_hashes(self, filelist, update, resumed=None):
+        # resumed is the start time of the run resumed with --resume, only given for the first pass
+        lastsave = datetime.now()
+        prevdir = ""
+        items = self.indexed_files(filelist, update)
+
+        if resumed != None:
+            # --resume: files the interrupted run already updated or found correct are done
+            items = ((f, row) for (f, row) in items if row == None or max(row[5] or 0, row[6] or 0) < resumed)
+
+        # Existing rows are rehashed with the algorithm they were stored with, new files with --algorithm
+        algorithm = lambda row: row[4] if row != None else self.args.algorithm
+        items = ((f, row, update and row != None and self.metadata_unchanged(f, *row[2:4])) for (f, row) in items)
+        wanted = lambda item: not self.args.test_run and not item[2] and (update or item[1] == None)
+        for ((f, row, unchanged), future) in self.prefetch_hashes(items, wanted, lambda item: (item[0], algorithm(item[1]))):
+            timediff = datetime.now() - lastsave
+            if timediff.total_seconds() > 300:
+                self.save_db()
+                lastsave = datetime.now()
+
+            dir = os.path.dirname(f)
+            if dir != prevdir:
+                prevdir = dir
+                self.output("Processing folder {}".format(prevdir))
+
+            if row == None:
+                if not self.args.test_run:
+                    self.output("Hashing {}".format(f), 1, 2)
+                    (result, error) = self.collect_hash(f, self.args.algorithm, future)
+                    if result != None:
+                        (hash, size, stat, fingerprint) = result
+                        self.stats.done(size, True)
+                        (folder, name) = split_path(f)
+                        self.writer.add("INSERT INTO hashes (directory, name, digest, algorithm, filesize, creation_ns, modified_ns, timestamp_ns, session, inode, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (self.directory_id(folder), name, hash, self.args.algorithm, size, stat.st_ctime_ns, stat.st_mtime_ns, time.time_ns(), self.args.session, stat.st_ino or None, fingerprint))
+                        yield file_result(f, "added", size, hash)
+                    else:
+                        yield file_result(f, self.report_error(f, error, "File was deleted:"))
+                        self.stats.done(0, False)
+                else:
+                    self.output("Hashing skipped {}".format(f), 0, 0)
+                    self.stats.done(0, False)
+                    yield file_result(f, "new")
+
+            else:
+                if update:
+                    oldhash = row[1]
+
+                    if unchanged:
+                        self.output("Size and date unchanged: {}".format(f), 1, 2)
+                        self.stats.done(row[2], False)
+                        yield file_result(f, "unchanged", row[2])
+                    else:
+                        (result, error) = self.collect_hash(f, algorithm(row), future)
+                        if result == None:
+                            yield file_result(f, self.report_error(f, error, "File was deleted:"))
+                            self.stats.done(0, False)
+                        elif result[0] != oldhash:
+                            (hash, size, stat, fingerprint) = result
+                            if not self.args.test_run:
+                                self.output("Updating file {}".format(f), 0, 0)
+                                # The new hash was just read from the file, an earlier check result no longer applies
+                                now = time.time_ns()
+                                self.writer.add("UPDATE hashes SET digest=?, filesize=?, creation_ns=?, modified_ns=?, timestamp_ns=?, session=?, inode=?, fingerprint=?, last_checked_ns=?, last_result=? WHERE id=?", (hash, size, stat.st_ctime_ns, stat.st_mtime_ns, now, self.args.session, stat.st_ino or None, fingerprint, now, "ok", row[0]))
+                            else:
+                                self.output("Update skipped: {}".format(f), 0, 0)
+                            yield file_result(f, "updated", size, hash)
                         else:
-                            output("Update skipped: {}".format(f), 0, 0)
+                            self.output("Hash already correct: {}".format(f), 1, 2)
+                            # Counts as a check, and marks the file done for --resume
+                            if not self.args.test_run:
+                                self.writer.add("UPDATE hashes SET last_checked_ns=?, last_result=? WHERE id=?", (time.time_ns(), "ok", row[0]))
+                            yield file_result(f, "ok", result[1], result[0])
+                        if result != None:
+                            self.stats.done(result[1], True)
+
+    def track_moves(self, abspath, filelist, moves):
+        # Generator over filelist without the files found to be moved: a new file with the same size and modified
+        # date as a missing row (and the same inode when both are known) is that file under a new path,
+        # its row gets the new path instead of the file being hashed again. Without an inode to confirm it, the
+        # fingerprint of the new file has to match the stored one when there is one. The moves are added to moves
+        # The rows without a file come from SQLite, see getSubset()
+        self.scan_to_temp(self.getFileList(abspath, True))
+        candidates = {}
+        (query, params) = self.missing_rows("hashes.id, directories.path || hashes.name, filesize, modified_ns, inode, fingerprint", self.getFilter(abspath))
+        for (id, filename, filesize, modified_ns, inode, fingerprint) in self.mem_db.execute(query, params):
+            if modified_ns != None:
+                candidates.setdefault((filesize, modified_ns // 1000), []).append((id, filename, inode, fingerprint, modified_ns))
+        for f in filelist:
+            if not candidates:
+                yield f
+                continue
+            try:
+                stat = os.stat(f)
+            except OSError:
+                yield f
+                continue
+            # Within 1us like metadata_unchanged(), rows upgraded from schema v1 have rounded microseconds
+            # so the candidate can be in the next or previous microsecond
+            matches = [m for us in range(stat.st_mtime_ns // 1000 - 1, stat.st_mtime_ns // 1000 + 2) for m in candidates.get((stat.st_size, us), []) if abs(stat.st_mtime_ns - m[4]) < 1000]
+            same_inode = [m for m in matches if stat.st_ino and m[2] == stat.st_ino]
+            if same_inode:
+                match = same_inode[0]
+            elif len(matches) == 1 and not (stat.st_ino and matches[0][2]):
+                match = matches[0]
+            else:
+                # No candidate, several that can't be told apart, or a different inode (a copy, not a move)
+                yield f
+                continue
+            if match[2] != stat.st_ino and match[3] != None:
+                try:
+                    confirmed = read_fingerprint(f)[0] == match[3]
+                except OSError:
+                    confirmed = False
+                if not confirmed:
+                    yield f
+                    continue
+            candidates[(stat.st_size, match[4] // 1000)].remove(match)
+            if not self.args.test_run:
+                self.output("Moved {} -> {}".format(match[1], f), 0, 0)
+                (folder, name) = split_path(f)
+                self.writer.add("UPDATE hashes SET directory=?, name=?, inode=? WHERE id=?", (self.directory_id(folder), name, stat.st_ino or None, match[0]))
+            else:
+                self.output("Move skipped {} -> {}".format(match[1], f), 0, 0)
+            moves.append(file_result(f, "moved", stat.st_size))
+
+    def shared_size_files(self, filelist):
+        # --skip-unique-sizes: a file whose size no other file in the tree or the DB has can't be a duplicate,
+        # so it's left unhashed (and out of the DB) for a later normal --generate
+        sizes = {}
+        for (size, count) in self.mem_db.execute("SELECT filesize, count(*) FROM hashes GROUP BY filesize"):
+            sizes[size] = count
+        files = []
+        for f in filelist:
+            try:
+                size = os.stat(f).st_size
+            except OSError:
+                size = None
+            files.append((f, size))
+            sizes[size] = sizes.get(size, 0) + 1
+        self.output("Skipping {} files with a unique size".format(sum(1 for (f, size) in files if size != None and sizes[size] == 1)), 1, 1)
+        return [f for (f, size) in files if size == None or sizes[size] > 1]
+
+    def find_duplicates(self, filter):
+        # Rows with the same digest (and algorithm) are identical files. Digests found more than once are
+        # listed from the digest index of each shard, added up across shards, and only then are their rows
+        # looked up and filtered by path. A group can lose all but one file to the path filter or to the
+        # algorithm, those are skipped. Empty files all match each other and waste nothing, they are left out.
+        (clause, params) = filter
+        counts = ["SELECT digest, count(*) AS n FROM {}.hashes GROUP BY digest".format(schema) for schema in self.shards]
+        if len(counts) == 1:
+            candidates = counts[0] + " HAVING n > 1"
+        else:
+            candidates = "SELECT digest FROM (" + " UNION ALL ".join(counts) + ") GROUP BY digest HAVING sum(n) > 1"
+        (query, params) = self.select_all("filesize, algorithm, digest, directories.path || hashes.name AS filename", (clause + " AND filesize > 0 AND digest IN (SELECT digest FROM candidates)", params))
+        rows = self.mem_db.execute("WITH candidates AS (" + candidates + ") " + query + " ORDER BY 1 DESC, 2, 3, 4", params)
+        groups = 0
+        files = 0
+        wasted = 0
+        for ((size, algorithm, digest), group) in groupby(rows, lambda row: row[:3]):
+            filenames = [row[3] for row in group]
+            if len(filenames) < 2:
+                continue
+            groups += 1
+            files += len(filenames)
+            wasted += size * (len(filenames) - 1)
+            self.output("{} identical files of {} bytes, {} bytes wasted:".format(len(filenames), size, size * (len(filenames) - 1)), 0, 0)
+            for filename in filenames:
+                self.output("    {}".format(self.paths.to_fs(filename)), 0, 0)
+                yield file_result(self.paths.to_fs(filename), "duplicate", size, digest)
+        self.output("{} groups, {} files, {:.1f} MB wasted".format(groups, files, wasted / 1048576), 0, 0)
+
+    def start_watch(self, abspath):
+        if sys.platform.startswith("linux"):
+            try:
+                return inotify_watcher(abspath, self.args.recursive, self.output)
+            except (OSError, AttributeError) as e:
+                self.output("inotify not available ({}), polling every {} seconds".format(e, self.args.poll_interval))
+        return poll_watcher(abspath, self.args.recursive, self.args.poll_interval)
+
+    def watch(self, abspath, watcher):
+        # Files are hashed once they've had no event for --settle seconds, in batches through generate_hashes()
+        # as an update so modified files get rehashed. The DB is saved after a batch: with --direct that's
+        # only a commit, otherwise the whole DB is written so at most once a minute.
+        self.output("Watching {} for changes, Ctrl-C to stop".format(abspath), 0, 0)
+        self.writer.flush()
+        ignored = set()
+        for f in [self.dbfile, self.args.outfile, self.args.stats_file]:
+            if f != None:
+                f = os.path.abspath(f)
+                ignored.update([f, f + "-wal", f + "-shm", f + "-journal", f + ".tmp"])
+        pending = {}
+        lastsave = time.monotonic()
+        unsaved = False
+        while True:
+            for f in watcher.changes(1):
+                if f not in ignored:
+                    pending[f] = time.monotonic()
+            now = time.monotonic()
+            settled = sorted(f for (f, changed) in pending.items() if now - changed >= self.args.settle)
+            for f in settled:
+                del pending[f]
+            files = [f for f in settled if os.path.isfile(f)]
+            for i in range(0, len(files), 400):
+                yield from self.generate_hashes(files[i:i + 400], True)
+                # The next batch looks its files up in mem_db
+                self.writer.flush()
+                unsaved = True
+            if unsaved and (self.args.direct or now - lastsave >= 60):
+                self.save_db()
+                lastsave = now
+                unsaved = False
+
+    def record_check(self, id, result):
+        # Written to the file DB by id, mem_db isn't saved in check mode
+        if not self.args.test_run:
+            self.writer.add("UPDATE hashes SET last_checked_ns=?, last_result=? WHERE id=?", (time.time_ns(), result, id))
+
+    def check_hashes(self, filter):
+        prevdir = ""
+        start = datetime.now()
+        lastsave = datetime.now()
+        checked_bytes = 0
+        crsr = self.mem_db.cursor()
+        (clause, params) = filter
+        query = "SELECT hashes.id, directories.path || hashes.name, digest, filesize, modified_ns, algorithm, fingerprint FROM " + FILES + " WHERE " + clause
+        params = list(params)
+        if self.args.fast:
+            # Rows hashed before fingerprints existed can't be triaged, a normal check fills them in
+            unfingerprinted = crsr.execute("SELECT count(*) FROM (" + query + " AND fingerprint IS NULL)", params).fetchone()[0]
+            if unfingerprinted:
+                self.output("{} files without a fingerprint skipped".format(unfingerprinted), 0, 0)
+            query += " AND fingerprint IS NOT NULL"
+        if self.args.older_than != None:
+            query += " AND (last_checked_ns IS NULL OR last_checked_ns < ?)"
+            params.append(time.time_ns() - int(self.args.older_than * 86400 * 1e9))
+        if self.run_resumed != None:
+            # --resume: skip the files the interrupted run already checked
+            query += " AND (last_checked_ns IS NULL OR last_checked_ns < ?)"
+            params.append(self.run_resumed)
+        if self.args.older_than != None or self.args.budget != None:
+            query += " ORDER BY last_checked_ns"
+        if self.stats.enabled:
+            self.stats.total(*crsr.execute("SELECT count(*), CAST(total(filesize) AS INTEGER) FROM (" + query + ")", params).fetchone())
+        rows = crsr.execute(query, params)
+        # Remapped once, the stat of --quick and the worker threads need the path in the file system too
+        items = ((row, filename, self.metadata_unchanged(filename, row[3], row[4])) for (row, filename) in ((row, self.paths.to_fs(row[1])) for row in rows))
+        # --fast only reads the fingerprint regions (algorithm None)
+        for ((row, filename, unchanged), future) in self.prefetch_hashes(items, lambda item: not item[2], lambda item: (item[1], None if self.args.fast else item[0][5])):
+            stored_hash = row[2]
+
+            timediff = datetime.now() - lastsave
+            if timediff.total_seconds() > 300:
+                if not self.args.test_run:
+                    self.writer.flush()
+                lastsave = datetime.now()
+
+            if self.args.budget != None:
+                (max_bytes, max_seconds) = self.args.budget
+                if (max_bytes != None and checked_bytes >= max_bytes) or (max_seconds != None and (datetime.now() - start).total_seconds() >= max_seconds):
+                    self.output("Budget reached, stopping check", 0, 0)
+                    break
+
+            if self.args.verbose > 0:
+                dir = os.path.dirname(filename)
+                if dir != prevdir:
+                    prevdir = dir
+                    self.output("Processing folder {}".format(prevdir))
+
+            self.output("Checking {}".format(filename), 2, 3)
+
+            if unchanged:
+                self.output("Size and date unchanged for {}".format(filename), 2, 3)
+                self.stats.done(row[3] or 0, False)
+                yield file_result(filename, "unchanged", row[3])
+            else:
+                (result, error) = self.collect_hash(filename, None if self.args.fast else row[5], future)
+
+                if result == None:
+                    error = self.report_error(filename, error, "File missing:")
+                    self.record_check(row[0], error)
+                    self.stats.done(0, False)
+                    yield file_result(filename, error)
+                elif self.args.fast:
+                    checked_bytes += result[3]
+                    if result[0] != row[6]:
+                        self.output("Fingerprint mismatch for {}".format(filename), 0, 0)
+                        # Never checked as far as --older-than goes, so the next full check reads it first
+                        if not self.args.test_run:
+                            self.writer.add("UPDATE hashes SET last_checked_ns=NULL, last_result='suspect' WHERE id=?", (row[0],))
+                        yield file_result(filename, "suspect", result[1], result[0])
                     else:
-                        output("Hash already correct: {}".format(f), 1, 2)
+                        self.output("Fingerprint OK for {}".format(filename), 2, 3)
+                        yield file_result(filename, "ok", result[1], result[0])
+                elif(result[0] != stored_hash):
+                    checked_bytes += result[1]
+                    self.output("Hash mismatch for {}".format(filename), 0, 0)
+                    self.record_check(row[0], "mismatch")
+                    yield file_result(filename, "mismatch", result[1], result[0])
                 else:
-                    output("File was deleted: {}".format(f), 0, 0)
-
-def check_hashes(filter):
-    prevdir = ""
-    lastsave = datetime.now()
-    crsr = mem_db.cursor()
-    for row in crsr.execute("SELECT * FROM hashes WHERE filename LIKE ?", (filter,)):
-        filename = row[1]
-        stored_hash = row[2]
-
-        timediff = datetime.now() - lastsave
-        if timediff.total_seconds() > 300 and outfile != None:
-            outfile.flush()
-            lastsave = datetime.now()
-
-        if args.verbose > 0:
-            dir = os.path.dirname(filename)
-            if dir != prevdir:
-                prevdir = dir
-                output("Processing folder {}".format(prevdir))
+                    checked_bytes += result[1]
+                    self.output("Hash OK for {}".format(filename), 2, 3)
+                    self.record_check(row[0], "ok")
+                    if row[6] == None and result[3] != None and not self.args.test_run:
+                        self.writer.add("UPDATE hashes SET fingerprint=? WHERE id=?", (result[3], row[0]))
+                    yield file_result(filename, "ok", result[1], result[0])
+                if result != None:
+                    self.stats.done(result[1], True, result[3] if self.args.fast else None)
 
-        output("Checking {}".format(filename), 2, 3)
+    def prune_db(self, abspath):
+        if not os.path.exists(abspath):
+            self.output("Invalid path! {}".format(abspath))
+            return
+        self.scan_to_temp(self.getFileList(abspath, True))
+        self.output("Pruning DB...")
+        (query, params) = self.missing_rows("hashes.id AS id, directories.path || hashes.name AS path", self.getFilter(abspath))
+        self.mem_db.execute("DROP TABLE IF EXISTS temp.pruned")
+        self.mem_db.execute("CREATE TEMP TABLE pruned AS " + query, params)
+        # In --batch-size chunks, one transaction each
+        count = self.mem_db.execute("SELECT max(rowid) FROM temp.pruned").fetchone()[0] or 0
+        for first in range(0, count, self.args.batch_size):
+            self.mem_db.execute("DELETE FROM hashes WHERE id IN (SELECT id FROM temp.pruned WHERE rowid > ? AND rowid <= ?)", (first, first + self.args.batch_size))
+            if not self.args.test_run:
+                self.mem_db.commit()
+        self.mem_db.execute("DELETE FROM directories WHERE id NOT IN (SELECT directory FROM hashes)")
+        if not self.args.test_run:
+            self.mem_db.commit()
+        # Deleted folders may come back with another id
+        self.directory_ids = {}
+        try:
+            for (path,) in self.mem_db.execute("SELECT path FROM temp.pruned ORDER BY rowid"):
+                yield file_result(path, "pruned")
+        finally:
+            # A test run leaves the DB as it was for the next calls
+            if self.args.test_run:
+                self.mem_db.rollback()
 
-        if os.path.isfile(filename):
-            hash = hash_file(filename)
+    def save_db(self):
+        if self.args.direct:
+            # WAL mode: a commit only appends the changed pages, SQLite checkpoints them incrementally
+            if not self.args.test_run:
+                self.writer.flush()
+        elif not self.args.test_run:
+            self.output("Saving DB...")
+            self.writer.flush()
+            clock = time.perf_counter()
+            self.mem_db.backup(self.db)
+            self.db.commit()
+            self.stats.phase_times()["db"] += time.perf_counter() - clock
 
-            if(hash != stored_hash):
-                output("Hash mismatch for {}".format(filename), 0, 0)
-            output("Hash OK for {}".format(filename), 2, 3)
+def options(**kwargs):
+    # Config for a HashCheck used from Python: the command line defaults, changed by keyword arguments
+    # named like the long options, e.g. options(update=True, jobs=4)
+    config = make_parser().parse_args(["--enumerate", os.curdir])
+    del config.path
+    config.enumerate = False
+    config.session = 1
+    for (name, value) in kwargs.items():
+        if not hasattr(config, name):
+            raise TypeError("Unknown option {}".format(name))
+        setattr(config, name, value)
+    config.algorithm = config.algorithm.lower()
+    if isinstance(config.budget, str):
+        config.budget = parse_budget(config.budget)
+    return config
+
+def list_shards(databases):
+    # -d can be repeated and can name a folder, every .sqlite file in it is then a shard
+    dbfiles = []
+    for database in databases:
+        if os.path.isdir(database):
+            dbfiles += sorted(os.path.join(database, f) for f in os.listdir(database) if f.endswith(".sqlite"))
         else:
-            output("File missing: {}".format(filename), 0, 0)
+            dbfiles.append(database)
+    return dbfiles
+
+def shard_root(db):
+    # The root stored when the shard was created, or for older DBs the deepest folder holding all their paths.
+    # Only reads, the shards that get selected are upgraded when opened or attached
+    tables = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    if "shard" in tables:
+        row = db.execute("SELECT root FROM shard").fetchone()
+        if row != None:
+            return row[0]
+    if "directories" in tables:
+        (first, last) = db.execute("SELECT min(path), max(path) FROM directories").fetchone()
+    elif "hashes" in tables:
+        (first, last) = db.execute("SELECT min(filename), max(filename) FROM hashes").fetchone()
+    else:
+        return None
+    if first == None:
+        return None
+    # The common prefix of the first and last paths is common to all of them
+    return split_path(os.path.commonprefix([first, last]))[0]
 
-def prune_db(abspath):
-    filelist = getSubset(abspath, False, True)
-    output("Pruning DB...")
-    mem_db.execute("DELETE FROM hashes WHERE filename in ({seq})".format(seq=','.join(['?']*len(filelist))), filelist)
-    mem_db.commit()
+def shard_target(path, paths):
+    # DB path of path as compared with the shard roots, folders with their trailing separator. None if it doesn't exist
+    if os.path.isfile(path):
+        return paths.to_db(path)
+    elif os.path.isdir(path):
+        return paths.to_db(path if path[-1] == os.sep else path + os.sep)
+    return None
+
+def select_shards(dbfiles, path, paths):
+    # Returns {dbfile: root} of the shards whose root holds path or is under it, all of them if path doesn't exist
+    roots = {}
+    for dbfile in dbfiles:
+        try:
+            shard = sqlite3.connect(dbfile)
+            root = shard_root(shard)
+            shard.close()
+        except sqlite3.DatabaseError:
+            raise HashCheckError("Invalid DB file {}".format(dbfile))
+        if root != None:
+            roots[dbfile] = root
+    target = shard_target(path, paths)
+    if target == None:
+        return roots
+    return {dbfile: root for (dbfile, root) in roots.items() if target.startswith(root) or root.startswith(target)}
 
-def save_db():
-    if not args.test_run:
-        output("Saving DB...")
-        mem_db.commit()
-        mem_db.backup(db)
-        db.commit()
+def run_mode(engine, abspath):
+    # The engine call for the mode given on the command line
+    if args.generate:
+        return engine.generate(abspath)
+    elif args.check:
+        return engine.check(abspath)
+    elif args.duplicates:
+        return engine.duplicates(abspath)
+    elif args.prune:
+        return engine.prune(abspath)
+    elif args.enumerate:
+        return engine.enumerate(abspath)
+    return engine.missing(abspath)
 
 def terminate(exitcode):
-    if args.generate or args.prune:
-        save_db()
-    db.close()
-    mem_db.close()
+    if engine != None:
+        engine.close()
+    if stats.enabled:
+        stats.report(False)
     sys.exit(exitcode)
 
 def exit_handler(signum, frame):
     output("Cancelled, exiting...")
     terminate(1)
 
-if __name__ == "__main__" :
+def main():
+    # The command line, also run by hashcheck_nocopy.py
+    global args, outfile, stats, engine
     sys.stdout.reconfigure(encoding='utf-8')
     signal.signal(signal.SIGINT, exit_handler)
+    signal.signal(signal.SIGTERM, exit_handler)
 
     args = parse_args()
 
     if args.outfile:
         try:
-            outfile = open(args.outfile, "w", encoding="utf-8")
+            # Line buffered, the results are in the file as they come
+            outfile = open(args.outfile, "w", encoding="utf-8", buffering=1)
         except:
             output("Unable to open output file", 0)
             sys.exit(1)
     else:
         outfile = None
 
-    if args.copy_to != None and os.path.isdir(os.path.abspath(args.copy_to)):
-        destpath = os.path.abspath(args.copy_to)
-        destfile = destination_file(destpath)
-    else:
-        destpath = None
-        destfile = None
-
     if args.session == None:
         args.session = 1
 
-    mem_db = sqlite3.connect(":memory:")
-    try:
-        db = sqlite3.connect(args.database)
-        db.execute("CREATE TABLE IF NOT EXISTS hashes(id INTEGER PRIMARY KEY, filename TEXT NOT NULL, sha256 TEXT NOT NULL, filesize INTEGER, creation_date TEXT, modified_date TEXT, timestamp TEXT, session INTEGER)")
-    except sqlite3.DatabaseError:
-        output("Invalid DB file")
-        sys.exit(2)
-    db.commit()
-    db.backup(mem_db)
-
-    start = datetime.now()
-
-    if args.db_path != None and args.fs_path != None and not args.generate and not args.prune:
-        mem_db.execute("UPDATE hashes SET filename = REPLACE(filename, ?, ?) WHERE filename LIKE ?", (args.db_path, args.fs_path, "%"+args.db_path+"%"))
-        mem_db.commit()
+    stats = progress(args.progress, args.stats_file, args.progress_interval)
 
-        if args.path_conv_to != None:
-            if args.path_conv_to == "w":
-                fromChar = "/"
-                toChar = "\\"
-            else:
-                fromChar = "\\"
-                toChar = "/"
-            mem_db.execute("UPDATE hashes SET filename = REPLACE(filename, ?, ?)", (fromChar, toChar))
-            mem_db.commit()
+    if args.db_path != None and not args.generate and not args.prune:
+        paths = path_translation(args.db_path, args.fs_path, args.path_conv_to)
+    else:
+        paths = path_translation(None, None, None)
 
     abspath = os.path.abspath(args.path)
-    if args.generate:
-        if not args.update:
-            filelist = getSubset(abspath, True, args.recursive)
-        else:
-            filelist = getFileList(abspath, args.recursive)
-        generate_hashes(filelist, args.update)
-    
-    elif args.check:
-        filter = getFilter(abspath)
-        check_hashes(filter)
+    start = datetime.now()
 
-    elif args.prune:
-        if os.path.exists(abspath):
-            prune_db(abspath)
+    engine = None
+    try:
+        dbfiles = list_shards(args.database)
+        sharded = len(dbfiles) != 1 or os.path.isdir(args.database[0])
+        roots = select_shards(dbfiles, abspath, paths) if sharded else {dbfile: None for dbfile in dbfiles}
+        selected = list(roots)
+        attached = []
+        new_root = None
+        if args.generate:
+            # New files need a single DB to go to: the shard whose root is the deepest one holding the path,
+            # as long as no other shard has a root under it
+            target = shard_target(abspath, paths)
+            if sharded and target == None:
+                raise HashCheckError("Invalid path! {}".format(abspath))
+            holding = [dbfile for dbfile in selected if roots[dbfile] == None or target.startswith(roots[dbfile])]
+            if len(holding) < len(selected):
+                output("{} is covered by several DBs: {}".format(abspath, ", ".join(selected)))
+                sys.exit(1)
+            elif holding:
+                targets = [max(holding, key=lambda dbfile: len(roots[dbfile] or ""))]
+            elif len(args.database) == 1 and os.path.isdir(args.database[0]):
+                targets = [os.path.join(args.database[0], re.sub(r"[^A-Za-z0-9]+", "_", abspath).strip("_") + ".sqlite")]
+                new_root = split_path(target)[0] if os.path.isfile(abspath) else target
+            else:
+                output("No DB covers {}, give the one to use with -d".format(abspath))
+                sys.exit(1)
+        elif args.check or args.prune:
+            # One shard after the other
+            targets = selected
         else:
-            output("Invalid path! {}".format(abspath))
-
-    elif args.enumerate or args.missing:
-        if args.enumerate:    
-            text = "New file:"
-            new = True
-        elif args.missing:
-            text = "File missing:"
-            new = False
+            # The other shards are attached to the first one and queried together
+            targets = selected[:1] or dbfiles[:1] or [":memory:"]
+            attached = selected[1:]
 
-        files = getSubset(abspath, new, args.recursive or args.missing)
-
-        for f in files:
-            output ("{} {}".format(text, f), 0, 0)
+        for dbfile in targets:
+            if sharded:
+                output("Using DB {}".format(dbfile), 1, 1)
+            engine = HashCheck(dbfile, args, output, stats)
+            if new_root != None:
+                engine.set_shard_root(new_root)
+            engine.attach(attached)
+            # Everything is output as it happens, the results themselves are for library use
+            for result in run_mode(engine, abspath):
+                pass
+            engine.close()
+            engine = None
+    except HashCheckError as e:
+        output(str(e))
+        terminate(e.exitcode)
 
     output ("Time: {}".format (datetime.now()-start), 0, 0)
     terminate(0)
 
+if __name__ == "__main__" :
+    main()
+
         
\ No newline at end of file